@@ -0,0 +1,85 @@
+"""Convert the CSV input files of the ingestion pipeline to Parquet.
+
+Every CSV file is parsed with pyarrow using the schema information stored in
+DataStore, and written next to the original file with a .parquet extension.
+The converted files can then be loaded with:
+
+    python dataflow_ingestion_configurable.py --input-format parquet ...
+
+Unlike the default CSV input of the pipeline, which replaces malformed values
+with the default of their type, the conversion requires every INTEGER, FLOAT,
+DATETIME and TIMESTAMP value to match the type of its column, and stops at the
+first file that does not. Such files can still be loaded from CSV.
+
+To get documentation on the script options run:
+    python convert_to_parquet.py --help
+"""
+
+import argparse
+import logging
+import os
+
+import pyarrow as pa
+from apache_beam.io.filesystems import FileSystems
+from pyarrow import csv as pa_csv
+from pyarrow import parquet as pq
+
+from dataflow_ingestion_configurable import (_build_gcs_uri,
+                                             _get_arrow_csv_options,
+                                             _get_table_fields,
+                                             _get_table_name,
+                                             _prepare_arrow_fields)
+
+
+def run(argv=None):
+    """The main function which converts the files"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-bucket',
+                        dest='input_bucket',
+                        required=True,
+                        help='GS bucket_name where the input files are present')
+    parser.add_argument(
+        '--input-path',
+        dest='input_path',
+        required=False,
+        help='GS folder name, if the input files are inside a bucket folder')
+    parser.add_argument(
+        '--input-files',
+        dest='input_files',
+        required=True,
+        help='Comma delimited names of all input files to be converted')
+    known_args = parser.parse_args(argv)
+
+    input_files = known_args.input_files.split(',')
+    table_fields = _get_table_fields(
+        [_get_table_name(f) for f in input_files])
+
+    for input_file in input_files:
+        fields = table_fields[_get_table_name(input_file)]
+        gs_path = _build_gcs_uri(known_args.input_bucket,
+                                 known_args.input_path, input_file)
+        parquet_path = _build_gcs_uri(
+            known_args.input_bucket, known_args.input_path,
+            os.path.splitext(input_file)[0] + '.parquet')
+        logging.info('Converting %s to %s' % (gs_path, parquet_path))
+
+        read_options, parse_options, convert_options = (
+            _get_arrow_csv_options(fields))
+        try:
+            with FileSystems.open(gs_path) as fp:
+                table = pa_csv.read_csv(fp,
+                                        read_options=read_options,
+                                        parse_options=parse_options,
+                                        convert_options=convert_options)
+        except pa.ArrowInvalid as e:
+            raise SystemExit('Cannot convert %s, load it with --input-format '
+                             'csv instead: %s' % (gs_path, e))
+        table = _prepare_arrow_fields(table, fields)
+        with FileSystems.create(parquet_path) as fp:
+            pq.write_table(table, fp, compression='snappy')
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    run()
@@ -15,150 +15,663 @@ To get documentation on the script options run:
 
 import argparse
 import csv
-import json
+import functools
 import logging
-import os
 import io
-from collections import OrderedDict
+import os
+import queue
+import tempfile
+import threading
+import time
 
 import apache_beam as beam
-from apache_beam.io.gcp.internal.clients.bigquery import (TableFieldSchema,
-                                                          TableSchema)
+from apache_beam.io.filesystem import CompressionTypes
+from apache_beam.io.filesystems import FileSystems
+from apache_beam.io.restriction_trackers import (OffsetRange,
+                                                 OffsetRestrictionTracker)
 from google.api_core.exceptions import InvalidArgument
+import google.auth
 from google.auth.exceptions import GoogleAuthError
 from google.cloud import datastore
+import orjson
+
+_LOG = logging.getLogger(__name__)
+
+# Table columns fetched from Datastore are cached in memory and on disk, so
+# that jobs launched repeatedly do not query Datastore every time
+_SCHEMA_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'dataflow_schemas')
+_SCHEMA_CACHE_TTL = 300
+_schema_cache = {}
 
 
 class FileCoder(beam.coders.Coder):
-    """Encode and decode CSV data coming from the files."""
+    """Encode and decode CSV data coming from the files.
 
-    def __init__(self, columns):
+    decode returns None for lines that do not have one value per column.
+    Bytes that are not valid in `encoding` are dropped instead of failing
+    the pipeline.
+    """
+
+    def __init__(self, columns, encoding='utf-8'):
+        import re
         self._columns = columns
+        self._columns_tuple = tuple(columns)
         self._num_columns = len(columns)
         self._delimiter = ","
+        self._encoding = encoding
+        # Fields only need quoting when they contain the delimiter, a quote
+        # or a line break; everything else can be joined as is.
+        self._needs_quote = re.compile(r'["\r\n%s]' %
+                                       re.escape(self._delimiter))
 
     def encode(self, value):
-        st = io.StringIO()
-        cw = csv.DictWriter(st,
-                            self._columns,
-                            delimiter=self._delimiter,
-                            quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-        cw.writerow(value)
-        return st.getvalue().strip('\r\n')
+        parts = []
+        for c in self._columns_tuple:
+            s = value[c]
+            s = '' if s is None else str(s)
+            if self._needs_quote.search(s):
+                s = '"%s"' % s.replace('"', '""')
+            parts.append(s)
+        return self._delimiter.join(parts).encode(self._encoding)
 
     def decode(self, value):
-        st = io.StringIO(value)
-        cr = csv.DictWriter(st,
-                            self._columns,
-                            delimiter=self._delimiter,
-                            quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-        return next(cr)
+        if isinstance(value, bytes):
+            value = value.decode(self._encoding, errors='ignore')
+        try:
+            row = next(csv.reader([value], delimiter=self._delimiter))
+        except csv.Error:
+            # e.g. a line break inside an unquoted field
+            return None
+        if len(row) != self._num_columns:
+            return None
+        return dict(zip(self._columns_tuple, row))
+
+
+class PrefetchingReader(io.RawIOBase):
+    """Read a file object ahead in a background thread.
+
+    Up to `ahead` chunks are downloaded while the current one is being
+    parsed, which hides the GCS latency behind the row conversion. Once
+    `limit` bytes have been read, the remaining data is fetched in small
+    chunks so that a reader that stops shortly after its limit does not
+    download data it will never use.
+    """
+
+    def __init__(self, fp, chunk_size=16 * 1024 * 1024, ahead=2, limit=None):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._limit = limit
+        self._queue = queue.Queue(maxsize=ahead)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._prefetch, daemon=True)
+        self._thread.start()
+
+    def _prefetch(self):
+        read = 0
+        try:
+            while not self._stop.is_set():
+                size = self._chunk_size
+                if self._limit is not None and read >= self._limit:
+                    size = 64 * 1024
+                chunk = self._fp.read(size)
+                read += len(chunk)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:  # pylint: disable=broad-except
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._chunk = memoryview(item)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        super().close()
+
+
+class CsvFileRestrictionProvider(beam.transforms.core.RestrictionProvider):
+    """Split CSV files in byte ranges that can be read in parallel.
+
+    Compressed files cannot be read from an arbitrary offset, so they get a
+    single [0, 1) restriction that is claimed once for the whole file.
+    """
+
+    def __init__(self, split_size=64 * 1024 * 1024):
+        self._split_size = split_size
+
+    def initial_restriction(self, element):
+        _, path = element
+        metadata_list = FileSystems.match([path])[0].metadata_list
+        if not metadata_list:
+            raise IOError('Input file %s not found' % path)
+        if (CompressionTypes.detect_compression_type(path) !=
+                CompressionTypes.UNCOMPRESSED):
+            return OffsetRange(0, 1)
+        return OffsetRange(0, metadata_list[0].size_in_bytes)
+
+    def create_tracker(self, restriction):
+        return OffsetRestrictionTracker(restriction)
+
+    def split(self, element, restriction):
+        return restriction.split(self._split_size)
+
+    def restriction_size(self, element, restriction):
+        return restriction.size()
+
+
+class ReadCsvFile(beam.DoFn):
+    """Read (table_name, path) elements and emit (table_name, row) pairs.
+
+    Every line belongs to the byte range in which it starts, so a range that
+    does not start at the beginning of the file skips its first partial
+    line. The header line of every file is skipped, and so are the lines
+    that do not have one value per column of their table.
+    """
+
+    def __init__(self, coders):
+        self._coders = coders
+
+    def start_bundle(self):
+        self._dropped = 0
+
+    def finish_bundle(self):
+        if self._dropped:
+            _LOG.warning('Dropped %s rows with a wrong number of columns',
+                         self._dropped)
+
+    def _decode(self, coder, line):
+        row = coder.decode(line.rstrip(b'\r\n'))
+        if row is None:
+            self._dropped += 1
+        return row
+
+    def process(self,
+                element,
+                restriction_tracker=beam.DoFn.RestrictionParam(
+                    CsvFileRestrictionProvider())):
+        table_name, path = element
+        coder = self._coders[table_name]
+        compression_type = CompressionTypes.detect_compression_type(path)
+        if compression_type != CompressionTypes.UNCOMPRESSED:
+            if not restriction_tracker.try_claim(0):
+                return
+            with FileSystems.open(path,
+                                  compression_type=compression_type) as fp:
+                fp.readline()
+                for line in iter(fp.readline, b''):
+                    row = self._decode(coder, line)
+                    if row is not None:
+                        yield table_name, row
+            return
+
+        restriction = restriction_tracker.current_restriction()
+        position = restriction.start
+        with FileSystems.open(
+                path, compression_type=CompressionTypes.UNCOMPRESSED) as fp:
+            if position:
+                fp.seek(position - 1)
+            # Download the next chunks while the current one is parsed
+            with io.BufferedReader(
+                    PrefetchingReader(fp, limit=restriction.size())) as reader:
+                if position:
+                    position += len(reader.readline()) - 1
+                else:
+                    position += len(reader.readline())
+                while restriction_tracker.try_claim(position):
+                    line = reader.readline()
+                    if not line:
+                        return
+                    position += len(line)
+                    row = self._decode(coder, line)
+                    if row is not None:
+                        yield table_name, row
+
+
+class ArrowCsvRead(beam.DoFn):
+    """Parse whole CSV files with the pyarrow CSV reader.
+
+    Reads (table_name, path) elements and emits (table_name, row) pairs,
+    with the values already converted as PrepareFieldTypes does and the
+    _RAWTIMESTAMP field set. The files are parsed in blocks by Arrow's
+    multithreaded C++ reader, but are not split between workers, and a value
+    that does not convert to the type of its column fails the file.
+    """
+
+    def __init__(self, table_fields, block_size=16 * 1024 * 1024):
+        import importlib
+        self._table_fields = table_fields
+        self._block_size = block_size
+        self._tm = importlib.import_module('time')
+
+    def process(self, element):
+        from pyarrow import csv as pa_csv
+        table_name, path = element
+        fields = self._table_fields[table_name]
+        read_options, parse_options, convert_options = _get_arrow_csv_options(
+            fields, block_size=self._block_size)
+        with FileSystems.open(path) as fp:
+            reader = pa_csv.open_csv(fp,
+                                     read_options=read_options,
+                                     parse_options=parse_options,
+                                     convert_options=convert_options)
+            for batch in reader:
+                raw_timestamp = int(self._tm.time())
+                for row in _prepare_arrow_fields(batch, fields).to_pylist():
+                    row['_RAWTIMESTAMP'] = raw_timestamp
+                    yield table_name, row
 
 
 class PrepareFieldTypes(beam.DoFn):
 
-    def __init__(self, encoding='utf-8', time_format='%Y-%m-%d %H:%M:%S %Z'):
+    def __init__(self, fields, time_format='%Y-%m-%d %H:%M:%S %Z'):
         import importlib
-        self._encoding = encoding
+        import re
+        self._fields = fields
         # Additional time format to use in case the default one does not work
-        self._time_format = [time_format, '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
+        self._time_format = (time_format, '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
         self._tm = importlib.import_module('time')
+        # Dates are read as UTC, whatever the time zone of the worker
+        self._cal = importlib.import_module('calendar')
+        # C implementations of int()/float() that return a fallback value
+        # instead of raising on malformed input
+        fastnumbers = importlib.import_module('fastnumbers')
+        self._fi, self._ff = fastnumbers.try_int, fastnumbers.try_float
+        # Dates matching the default formats are converted without strptime
+        self._ts_re = re.compile(r'(\d{4})-(\d{2})-(\d{2})'
+                                 r'(?:[ T](\d{2}):(\d{2}):(\d{2}))?'
+                                 r'(?: ?(?:UTC|GMT|Z))?')
+        self._cum_days = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304,
+                          334, 365)
+
+    def start_bundle(self):
+        self._warn_count = 0
+        # Resolve the converter and default value of every column once, so
+        # that process does not dispatch on the field type for every cell.
+        converters = []
+        for k, ftype in self._fields.items():
+            default = self._return_default_value(ftype)
+            convert = self._make_converter(ftype, default)
+            if convert is None:
+                _LOG.warning('Unknown field type %s for column %s', ftype, k)
+                convert = lambda v, default=default: default
+            converters.append((k, convert, default))
+        self._converters = tuple(converters)
 
     def _return_default_value(self, ftype):
         if ftype == 'INTEGER':
             return 0
         elif ftype == 'FLOAT':
             return 0
-        elif ftype == 'DATATIME':
-            return self._tm.mktime(self._tm.strptime('1970-01-01', '%Y-%m-%d'))
+        elif ftype == 'DATETIME':
+            return float(
+                self._cal.timegm(self._tm.strptime('1970-01-01', '%Y-%m-%d')))
         elif ftype == 'TIMESTAMP':
             return 0
         else:
             return ''
 
-    def process(self, element, fields):
-        if not hasattr(element, '__len__'):
-            logging.warn('Element %s has no length' % element)
-            return []
-        if len(element) != len(fields):
-            logging.warn('Row has %s elements instead of %s' %
-                         (len(element), len(fields)))
-            return []
-        for k, v in element.items():
-            ftype = fields[k]
+    def _make_converter(self, ftype, default):
+        import functools
+        if ftype == 'STRING':
+            # FileCoder already decoded the values
+            return str
+        elif ftype == 'INTEGER':
+            # Underscores are accepted as int()/float() do, so that cells
+            # convert the same way as in the numpy cast of
+            # BatchPrepareFieldTypes
+            return functools.partial(
+                self._fi,
+                allow_underscores=True,
+                on_fail=self._numeric_fallback(ftype, default))
+        elif ftype == 'FLOAT':
+            return functools.partial(
+                self._ff,
+                allow_underscores=True,
+                on_fail=self._numeric_fallback(ftype, default))
+        elif ftype == 'DATETIME':
+            return self._to_datetime
+        elif ftype == 'TIMESTAMP':
+            return self._to_timestamp
+        return None
+
+    def _numeric_fallback(self, ftype, default):
+
+        def fallback(v):
+            self._warn(
+                'Cannot convert type %s for element %s. '
+                'Returning default value.', ftype, v)
+            return default
+
+        return fallback
+
+    def _fast_epoch(self, v):
+        m = self._ts_re.fullmatch(v)
+        if m is None:
+            return None
+        year, month, day, hour, minute, second = (
+            int(g) if g else 0 for g in m.groups())
+        if not 1 <= month <= 12:
+            return None
+        leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+        month_days = self._cum_days[month] - self._cum_days[month - 1]
+        if month == 2 and leap:
+            month_days += 1
+        if not (1 <= day <= month_days and hour < 24 and minute < 60 and
+                second < 62):
+            return None
+        # Leap days between 1970 and the start of the year
+        y = year - 1
+        leap_days = y // 4 - y // 100 + y // 400 - 477
+        days = ((year - 1970) * 365 + leap_days + self._cum_days[month - 1] +
+                (month > 2 and leap) + day - 1)
+        return days * 86400 + hour * 3600 + minute * 60 + second
+
+    def _to_datetime(self, v):
+        epoch = self._fast_epoch(v)
+        if epoch is not None:
+            return float(epoch)
+        for fmt in self._time_format:
             try:
-                if not v:
-                    v = self._return_default_value(ftype)
-                elif ftype == 'STRING':
-                    if isinstance(v, str):
-                        v = v.decode(self._encoding, errors='ignore')
-                elif ftype == 'INTEGER':
-                    v = int(v)
-                elif ftype == 'FLOAT':
-                    v = float(v)
-                elif ftype == 'DATETIME':
-                    try:
-                        v = self._tm.mktime(
-                            self._tm.strptime(v, self._time_format))
-                    except (ValueError, TypeError) as e:
-                        logging.warn('Cannot convert type %s for element %s: '
-                                     '%s. Returning default value.' %
-                                     (ftype, v, e))
-                        v = self._return_default_value(ftype)
-
-                elif ftype == 'TIMESTAMP':
-                    for fmt in (self._time_format):
-                        try:
-                            v = int(self._tm.mktime(self._tm.strptime(v, fmt)))
-                        except ValueError:
-                            pass
-                        else:
-                            break
-                    if not isinstance(v, int):
-                        logging.warning(
-                            'Cannot convert date %s. Expected value of type int'
-                            % v)
-                        v = self._return_default_value(ftype)
-                else:
-                    logging.warning('Unknown field type %s' % ftype)
-                    v = self._return_default_value(ftype)
-            except (TypeError, ValueError) as e:
-                logging.warning('Cannot convert type %s for element %s: '
-                                '%s. Returning default value.' % (ftype, v, e))
-                v = self._return_default_value(ftype)
-            element[k] = v
+                return float(self._cal.timegm(self._tm.strptime(v, fmt)))
+            except ValueError:
+                pass
+        raise ValueError('Cannot convert date %s' % v)
+
+    def _to_timestamp(self, v):
+        return int(self._to_datetime(v))
+
+    def _warn(self, msg, *args):
+        # Bad rows tend to come in bulk: only log one in every 1000 of them
+        # per bundle, and never format the message when it is not logged
+        self._warn_count += 1
+        if (self._warn_count % 1000 == 1 and
+                _LOG.isEnabledFor(logging.WARNING)):
+            _LOG.warning(msg + ' (%s warnings in this bundle)',
+                         *(args + (self._warn_count,)))
+
+    def _convert_value(self, k, convert, default, v):
+        if not v:
+            return default
+        try:
+            return convert(v)
+        except (TypeError, ValueError) as e:
+            self._warn(
+                'Cannot convert type %s for element %s: '
+                '%s. Returning default value.', self._fields[k], v, e)
+            return default
+
+    def process(self, element):
+        for k, convert, default in self._converters:
+            element[k] = self._convert_value(k, convert, default, element[k])
+        element['_RAWTIMESTAMP'] = int(self._tm.time())
         return [element]
 
 
-class InjectTimestamp(beam.DoFn):
+class BatchPrepareFieldTypes(PrepareFieldTypes):
+    """Convert batches of rows one column at a time.
 
-    def process(self, element):
-        import time
-        element['_RAWTIMESTAMP'] = int(time.mktime(time.gmtime()))
-        return [element]
+    Rows are transposed into one list per column. INTEGER and FLOAT columns
+    are converted with a single numpy cast, and fall back to the per-cell
+    converters when the batch holds empty or malformed values.
+    """
+
+    def __init__(self, fields, **kwargs):
+        import importlib
+        super().__init__(fields, **kwargs)
+        self._np = importlib.import_module('numpy')
 
+    def start_bundle(self):
+        super().start_bundle()
+        dtypes = {'INTEGER': self._np.int64, 'FLOAT': self._np.float64}
+        self._dtypes = {k: dtypes.get(v) for k, v in self._fields.items()}
 
-def _fetch_table(table_name):
+    def _convert_column(self, k, convert, default, values):
+        dtype = self._dtypes[k]
+        if dtype is not None:
+            try:
+                return self._np.asarray(values).astype(dtype).tolist()
+            except (TypeError, ValueError, OverflowError):
+                pass
+        return [self._convert_value(k, convert, default, v) for v in values]
+
+    def process(self, batch):
+        columns = [
+            self._convert_column(k, convert, default,
+                                 [element[k] for element in batch])
+            for k, convert, default in self._converters
+        ]
+        names = [k for k, _, _ in self._converters] + ['_RAWTIMESTAMP']
+        raw_timestamp = int(self._tm.time())
+        for values in zip(*columns):
+            yield dict(zip(names, values + (raw_timestamp,)))
+
+
+def _fetch_tables(client, table_names):
+    """Fetch the Datastore entities of all tables in one batched call."""
+    keys = [client.key('Table', name) for name in sorted(set(table_names))]
+    return {entity.key.name: entity for entity in client.get_multi(keys)}
+
+
+def _get_project():
+    """Return the project Datastore is queried in, or None if unknown."""
+    project = os.environ.get('GOOGLE_CLOUD_PROJECT')
+    if project:
+        return project
     try:
-        client = datastore.Client()
+        return google.auth.default()[1]
     except GoogleAuthError:
-        # TODO(lcaggioni.ludomagno): fail gracefully
-        pass
-    return client.get(client.key('Table', table_name))
+        return None
 
 
-def _get_bq_schema(fields):
+def _cache_path(project, table_name):
+    return os.path.join(_SCHEMA_CACHE_DIR, project, table_name + '.json')
+
+
+def _load_cached_columns(project, table_name):
+    """Return the cached columns of a table, or None if missing or stale."""
+    now = time.time()
+    cached = _schema_cache.get((project, table_name))
+    if cached and now - cached[0] < _SCHEMA_CACHE_TTL:
+        return cached[1]
+    path = _cache_path(project, table_name)
+    try:
+        mtime = os.path.getmtime(path)
+        if now - mtime >= _SCHEMA_CACHE_TTL:
+            return None
+        with open(path, 'rb') as f:
+            columns = f.read()
+    except OSError:
+        return None
+    _schema_cache[(project, table_name)] = (mtime, columns)
+    return columns
+
+
+def _store_cached_columns(project, table_name, columns):
+    _schema_cache[(project, table_name)] = (time.time(), columns)
+    path = _cache_path(project, table_name)
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so that concurrent jobs never
+        # read a partially written cache entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(columns)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning('Cannot cache columns of table %s: %s' %
+                        (table_name, e))
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+def _get_table_fields(table_names):
+    """Return the fields of every table, keyed by table name."""
+    # Tables are cached per project, as the same table name can hold a
+    # different schema in another project
+    project = _get_project()
+    table_columns = {}
+    if project is not None:
+        for table_name in table_names:
+            columns = _load_cached_columns(project, table_name)
+            if columns is not None:
+                table_columns[table_name] = columns
+
+    missing = [t for t in table_names if t not in table_columns]
+    if missing:
+        logging.info('Retrieving information for tables %s' %
+                     (', '.join(missing)))
+        try:
+            client = datastore.Client(project=project)
+        except GoogleAuthError as e:
+            raise SystemExit('Cannot connect to Datastore: %s' % e)
+        try:
+            tables = _fetch_tables(client, missing)
+        except InvalidArgument as e:
+            raise SystemExit('Error getting information for tables [%s]: %s' %
+                             (', '.join(missing), e))
+        for table_name, table in tables.items():
+            table_columns[table_name] = table['columns']
+            if project is not None:
+                _store_cached_columns(project, table_name, table['columns'])
+
+    table_fields = {}
+    for table_name in table_names:
+        columns = table_columns.get(table_name)
+        if not columns:
+            raise SystemExit('No table found for %s' % (table_name))
+        if table_name not in table_fields:
+            # orjson parses the UTF-8 bytes directly, and plain dicts keep
+            # the order of the columns
+            table_fields[table_name] = orjson.loads(columns)
+    return table_fields
+
+
+def _build_gcs_uri(bucket, path, name):
+    """Return the gs:// URI of a file, the bucket may include the scheme."""
+    if bucket.startswith('gs://'):
+        bucket = bucket[len('gs://'):]
+    path = path.strip('/') if path else ''
+    return 'gs://%s/%s%s' % (bucket.strip('/'), path + '/' if path else '',
+                             name)
+
+
+def _get_table_name(input_file):
+    return os.path.splitext(input_file)[0].split('_')[0]
+
+
+def _get_arrow_csv_options(fields, block_size=None):
+    """Return the pyarrow CSV read, parse and convert options for the fields.
+
+    Rows that do not have one value per column are skipped.
+    """
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    types = {
+        'STRING': pa.string(),
+        'INTEGER': pa.int64(),
+        'FLOAT': pa.float64(),
+        'DATETIME': pa.timestamp('s'),
+        'TIMESTAMP': pa.timestamp('s'),
+    }
+    read_options = pa_csv.ReadOptions(column_names=list(fields), skip_rows=1)
+    if block_size:
+        read_options.block_size = block_size
+    parse_options = pa_csv.ParseOptions(invalid_row_handler=lambda row: 'skip')
+    # Accept the zone suffixes that PrepareFieldTypes reads as UTC, which
+    # ISO8601 rejects for timestamps without a time zone
+    timestamp_parsers = [pa_csv.ISO8601]
+    for suffix in ('Z', ' Z', 'UTC', ' UTC', 'GMT', ' GMT'):
+        timestamp_parsers += [
+            '%Y-%m-%d %H:%M:%S' + suffix, '%Y-%m-%dT%H:%M:%S' + suffix,
+            '%Y-%m-%d' + suffix
+        ]
+    convert_options = pa_csv.ConvertOptions(
+        column_types={k: types.get(v, pa.string()) for k, v in fields.items()},
+        timestamp_parsers=timestamp_parsers)
+    return read_options, parse_options, convert_options
+
+
+def _prepare_arrow_fields(data, fields):
+    """Give an Arrow table or record batch the values of PrepareFieldTypes.
+
+    Dates become epoch seconds and empty values the default of their type.
+    """
+    import pyarrow as pa
+
+    columns = []
+    for column, ftype in zip(data.columns, fields.values()):
+        if ftype == 'TIMESTAMP':
+            column = column.cast(pa.int64()).fill_null(0)
+        elif ftype == 'DATETIME':
+            column = column.cast(pa.int64()).cast(pa.float64()).fill_null(0)
+        elif ftype in ('INTEGER', 'FLOAT'):
+            column = column.fill_null(0)
+        else:
+            column = column.fill_null('')
+        columns.append(column)
+    return type(data).from_arrays(columns, names=data.schema.names)
+
+
+def _inject_timestamp(row):
+    import time
+    row['_RAWTIMESTAMP'] = int(time.time())
+    return row
+
+
+@functools.lru_cache(maxsize=None)
+def _build_bq_schema(field_items):
     bq_fields = []
-    for k, v in fields.items():
-        bq_fields.append(
-            TableFieldSchema(name=k, type=v, description='Field %s' % k))
-    bq_fields.append(
-        TableFieldSchema(name='_RAWTIMESTAMP',
-                         type='TIMESTAMP',
-                         description='Injected timestamp'))
-    return TableSchema(fields=bq_fields)
+    for k, v in field_items:
+        bq_fields.append({
+            'name': k,
+            'type': v,
+            'description': 'Field %s' % k
+        })
+    bq_fields.append({
+        'name': '_RAWTIMESTAMP',
+        'type': 'TIMESTAMP',
+        'description': 'Injected timestamp'
+    })
+    return {'fields': bq_fields}
+
+
+def _get_bq_schema(fields):
+    # The items are passed as a tuple rather than a frozenset, which would
+    # lose the order of the columns
+    return _build_bq_schema(tuple(fields.items()))
 
 
 def run(argv=None):
@@ -185,6 +698,29 @@ def run(argv=None):
                         required=True,
                         default='rawdata',
                         help='Output BQ dataset to write the results to')
+    parser.add_argument(
+        '--input-format',
+        dest='input_format',
+        required=False,
+        default='csv',
+        choices=['csv', 'parquet'],
+        help='Format of the input files, parquet reads the files created by '
+        'convert_to_parquet.py next to the CSV files, which fails on CSV '
+        'files with values that do not match the type of their column')
+    parser.add_argument(
+        '--csv-reader',
+        dest='csv_reader',
+        required=False,
+        default='beam',
+        choices=['beam', 'arrow'],
+        help='Reader of the CSV files, arrow parses whole files with pyarrow '
+        'and requires every value to match the type of its column')
+    parser.add_argument(
+        '--temp-location',
+        dest='temp_location',
+        required=False,
+        help='GS path where files are staged before being loaded into BQ, '
+        'defaults to the temp_location of the pipeline')
 
     # Parse arguments from the command line
     known_args, pipeline_args = parser.parse_known_args(argv)
@@ -193,46 +729,77 @@ def run(argv=None):
     logging.info('START - Pipeline')
     p = beam.Pipeline(argv=pipeline_args)
 
-    for input_file in known_args.input_files.split(','):
-        logging.info('START - Preparing file %s' % (input_file))
-
-        table_name = os.path.splitext(input_file)[0].split('_')[0]
-        logging.info('Retrieving information for table %s' % (table_name))
-
-        try:
-            table = _fetch_table(table_name)
-        except InvalidArgument as e:
-            raise SystemExit('Error getting information for table [%s]: %s' %
-                             (table_name, e))
-        if not table:
-            raise SystemExit('No table found')
-
-        fields = json.loads(table['columns'].decode('utf-8'),
-                            object_pairs_hook=OrderedDict)
-        gs_path = os.path.join(
-            known_args.input_bucket, *[
-                known_args.input_path if known_args.input_path else "",
-                input_file
-            ])
+    input_files = known_args.input_files.split(',')
+    table_fields = _get_table_fields(
+        [_get_table_name(f) for f in input_files])
+
+    # Files loaded into the same table share its fields and its sink
+    file_tables = []
+    for input_file in input_files:
+        if known_args.input_format == 'parquet':
+            input_file = os.path.splitext(input_file)[0] + '.parquet'
+        gs_path = _build_gcs_uri(known_args.input_bucket,
+                                 known_args.input_path, input_file)
         logging.info('GS path being read from: %s' % (gs_path))
+        if not FileSystems.exists(gs_path):
+            raise SystemExit('Input file %s not found' % (gs_path))
+        file_tables.append((_get_table_name(input_file), gs_path))
 
-        (p | 'Read From Text - ' + input_file >> beam.io.ReadFromText(
-            gs_path, coder=FileCoder(list(fields.keys())), skip_header_lines=1)
-         | 'Prepare Field Types - ' + input_file >> beam.ParDo(
-             PrepareFieldTypes(), fields) |
-         'Inject Timestamp - ' + input_file >> beam.ParDo(InjectTimestamp()) |
-         'Write to BigQuery - ' + input_file >> beam.io.Write(
-             beam.io.BigQuerySink(
-                 # The table name passed in from the command line
-                 known_args.bq_dataset + '.' + table_name,
-                 # Schema of the table
-                 schema=_get_bq_schema(fields),
-                 # Creates the table in BigQuery if it does not exist
-                 create_disposition=beam.io.BigQueryDisposition.
-                 CREATE_IF_NEEDED,
-                 # Data will be appended to the table
-                 write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND)))
-        logging.info('END - Preparing file %s' % (input_file))
+    if known_args.input_format == 'csv':
+        if known_args.csv_reader == 'arrow':
+            read_csv = ArrowCsvRead(table_fields)
+        else:
+            # All files are read by a single splittable DoFn, so that
+            # Dataflow can split large files and rebalance the work between
+            # the workers
+            read_csv = ReadCsvFile({
+                k: FileCoder(list(v.keys())) for k, v in table_fields.items()
+            })
+        table_index = {k: i for i, k in enumerate(table_fields)}
+        rows = (p | 'Create File Paths' >> beam.Create(file_tables)
+                | 'Read CSV Files' >> beam.ParDo(read_csv)
+                | 'Route To Table' >> beam.Partition(
+                    lambda element, n, table_index: table_index[element[0]],
+                    len(table_fields), table_index))
+
+    for index, (table_name, fields) in enumerate(table_fields.items()):
+        logging.info('START - Preparing table %s' % (table_name))
+
+        if known_args.input_format == 'parquet':
+            # Parquet files are already typed, only the timestamp is missing
+            table_rows = (
+                p | 'Create File Paths - ' + table_name >> beam.Create(
+                    [path for t, path in file_tables if t == table_name])
+                | 'Read From Parquet - ' + table_name >>
+                beam.io.ReadAllFromParquet()
+                | 'Inject Timestamp - ' + table_name >> beam.Map(
+                    _inject_timestamp))
+        elif known_args.csv_reader == 'arrow':
+            table_rows = (rows[index]
+                          | 'Drop Table Name - ' + table_name >> beam.Values())
+        else:
+            table_rows = (
+                rows[index]
+                | 'Drop Table Name - ' + table_name >> beam.Values()
+                | 'Batch Rows - ' + table_name >> beam.BatchElements(
+                    min_batch_size=512, max_batch_size=4096)
+                | 'Prepare Field Types - ' + table_name >> beam.ParDo(
+                    BatchPrepareFieldTypes(fields)))
+
+        (table_rows
+         | 'Write to BigQuery - ' + table_name >> beam.io.WriteToBigQuery(
+             # The table name passed in from the command line
+             known_args.bq_dataset + '.' + table_name,
+             # Schema of the table
+             schema=_get_bq_schema(fields),
+             # Creates the table in BigQuery if it does not exist
+             create_disposition=beam.io.BigQueryDisposition.CREATE_IF_NEEDED,
+             # Data will be appended to the table
+             write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
+             # Stage the rows in GCS and import them with load jobs
+             method=beam.io.WriteToBigQuery.Method.FILE_LOADS,
+             custom_gcs_temp_location=known_args.temp_location))
+        logging.info('END - Preparing table %s' % (table_name))
 
     p.run().wait_until_finish()
     logging.info('END - Pipeline')
@@ -0,0 +1,122 @@
+"""Tests of the conversions done by dataflow_ingestion_configurable.py.
+
+Run them from this directory with:
+
+    python -m unittest test_dataflow_ingestion_configurable
+"""
+
+import io
+import os
+import random
+import time
+import unittest
+
+from pyarrow import csv as pa_csv
+
+from dataflow_ingestion_configurable import (BatchPrepareFieldTypes,
+                                             FileCoder, PrepareFieldTypes,
+                                             _get_arrow_csv_options,
+                                             _prepare_arrow_fields)
+
+
+class BatchPrepareFieldTypesTest(unittest.TestCase):
+
+    def _convert(self, batch):
+        dofn = BatchPrepareFieldTypes({'i': 'INTEGER', 'f': 'FLOAT'})
+        dofn.start_bundle()
+        return list(dofn.process([{'i': v, 'f': v} for v in batch]))
+
+    def test_numpy_cast_matches_per_cell_conversion(self):
+        # A malformed cell makes the whole column fall back to the per-cell
+        # converters, which must give the same values as the numpy cast
+        for value in ('1_000', '1_0.5', ' 7 ', '+3', '0012', '1.0', '1e3',
+                      'nan', 'inf', '-0'):
+            cast = self._convert([value])[0]
+            per_cell = self._convert([value, 'malformed'])[0]
+            for k in ('i', 'f'):
+                self.assertEqual(repr(cast[k]), repr(per_cell[k]),
+                                 '%s of %r' % (k, value))
+
+
+class PrepareFieldTypesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+
+    def tearDown(self):
+        if self._tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self._tz
+        time.tzset()
+
+    def test_datetime_is_utc_for_every_format(self):
+        dofn = PrepareFieldTypes({'d': 'DATETIME', 't': 'TIMESTAMP'},
+                                 time_format='%m/%d/%Y')
+        dofn.start_bundle()
+        for value in ('2021-01-01', '2021-01-01 00:00:00 UTC', '01/01/2021'):
+            row = dofn.process({'d': value, 't': value})[0]
+            self.assertEqual((row['d'], row['t']), (1609459200.0, 1609459200),
+                             value)
+        row = dofn.process({'d': '', 't': ''})[0]
+        self.assertEqual((row['d'], row['t']), (0.0, 0))
+
+
+class ArrowCsvOptionsTest(unittest.TestCase):
+
+    def test_dates_match_prepare_field_types(self):
+        fields = {'d': 'DATETIME', 't': 'TIMESTAMP'}
+        values = ('2021-01-01', '2021-01-01 05:00:00', '2021-01-01T05:00:00',
+                  '2021-01-01T05:00:00Z', '2021-01-01 05:00:00 UTC',
+                  '2021-01-01 05:00:00 GMT', '2021-01-01 UTC')
+        data = 'd,t\n' + ''.join('%s,%s\n' % (v, v) for v in values)
+        read_options, parse_options, convert_options = (
+            _get_arrow_csv_options(fields))
+        table = pa_csv.read_csv(io.BytesIO(data.encode()),
+                                read_options=read_options,
+                                parse_options=parse_options,
+                                convert_options=convert_options)
+        rows = _prepare_arrow_fields(table, fields).to_pylist()
+
+        dofn = PrepareFieldTypes(fields)
+        dofn.start_bundle()
+        for value, row in zip(values, rows):
+            expected = dofn.process({'d': value, 't': value})[0]
+            self.assertEqual((row['d'], row['t']),
+                             (expected['d'], expected['t']), value)
+
+
+class FileCoderTest(unittest.TestCase):
+
+    def _coder(self):
+        return FileCoder(['a', 'b', 'c'])
+
+    def test_decode(self):
+        self.assertEqual(self._coder().decode(b'1,"x,""y""",'), {
+            'a': '1',
+            'b': 'x,"y"',
+            'c': ''
+        })
+
+    def test_encode_decode_round_trip(self):
+        coder = self._coder()
+        rnd = random.Random(0)
+        for _ in range(1000):
+            row = {
+                k: ''.join(rnd.choice('ab ,"\r\n\xe9')
+                           for _ in range(rnd.randint(0, 6)))
+                for k in ('a', 'b', 'c')
+            }
+            self.assertEqual(coder.decode(coder.encode(row)), row)
+
+    def test_decode_malformed_lines(self):
+        coder = self._coder()
+        self.assertIsNone(coder.decode(b'1,2'))
+        self.assertIsNone(coder.decode(b'1,2,3,4'))
+        self.assertIsNone(coder.decode(b'a\rb,c,d'))
+
+
+if __name__ == '__main__':
+    unittest.main()